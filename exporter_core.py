@@ -0,0 +1,1116 @@
+"""
+iDrive e2 Prometheus Exporter core: configuration, S3 scanning, metrics and health handler
+"""
+
+import os
+import boto3
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.config import Config
+from botocore.credentials import Credentials
+from botocore.handlers import validate_bucket_name
+from botocore.utils import parse_timestamp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Gauge, Info
+import time
+import logging
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+import json
+import orjson
+import threading
+import multiprocessing
+import gzip
+import io
+import csv
+import asyncio
+import atexit
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote
+
+from hotloop import aggregate, aggregate_list_body, etree
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Configuration from environment
+ENDPOINT_URL = os.getenv('ENDPOINT_URL', 'https://s3.idrivee2.com')
+ACCESS_KEY = os.getenv('ACCESS_KEY')
+SECRET_KEY = os.getenv('SECRET_KEY')
+REGION_NAME = os.getenv('REGION_NAME', 'us-east-1')
+BUCKETS = os.getenv('BUCKETS', '').split(',')
+SCRAPE_INTERVAL = int(os.getenv('SCRAPE_INTERVAL', '300'))  # 5 minutes default
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '16'))  # Concurrent listings per bucket
+USE_INVENTORY = os.getenv('USE_INVENTORY', '0') == '1'  # Read S3 Inventory reports instead of listing
+INVENTORY_BUCKET = os.getenv('INVENTORY_BUCKET', '')
+INVENTORY_PREFIX = os.getenv('INVENTORY_PREFIX', '').strip('/')
+INVENTORY_SELECT = os.getenv('INVENTORY_SELECT', '0') == '1'  # Aggregate inventory files server-side with S3 Select
+CACHE_TTL = int(os.getenv('CACHE_TTL', '0'))  # Reuse unchanged bucket totals for this long, 0 disables
+STATE_FILE = os.getenv('STATE_FILE', '')  # Persist totals here to scan incrementally across restarts
+FULL_RESCAN_EVERY = int(os.getenv('FULL_RESCAN_EVERY', '12'))  # Incremental scans between full rescans
+ASYNC_LISTING = os.getenv('ASYNC_LISTING', '0') == '1'  # List with aiohttp instead of boto3
+PROCESS_POOL_THRESHOLD = int(os.getenv('PROCESS_POOL_THRESHOLD', '32'))  # Scan in processes above this many buckets
+
+# Up to 16 buckets are scanned at once, each with up to SHARD_WORKERS listings
+# in flight, so size the HTTP pool to match and avoid "Connection pool is full"
+MAX_POOL_CONNECTIONS = max(32, min(len(BUCKETS), 16) * SHARD_WORKERS)
+
+# Cap on the MaxKeys=1 listings spent splitting one bucket into shards
+MAX_SPLIT_REQUESTS = 8 * SHARD_WORKERS
+
+# Validate configuration
+logger.info("=" * 60)
+logger.info("iDrive e2 Prometheus Exporter Starting...")
+logger.info("=" * 60)
+logger.info(f"Endpoint: {ENDPOINT_URL}")
+logger.info(f"Region: {REGION_NAME}")
+logger.info(f"Buckets: {BUCKETS}")
+logger.info(f"Scrape interval: {SCRAPE_INTERVAL} seconds")
+logger.info(f"Shard workers per bucket: {SHARD_WORKERS}")
+logger.info(f"HTTP connection pool: {MAX_POOL_CONNECTIONS}")
+if CACHE_TTL:
+    logger.info(f"Cache TTL: {CACHE_TTL} seconds")
+if ASYNC_LISTING:
+    logger.info("Listing: async (aiohttp)")
+if STATE_FILE:
+    logger.info(f"State file: {STATE_FILE} (full rescan every {FULL_RESCAN_EVERY} scans)")
+if USE_INVENTORY:
+    logger.info(f"Inventory: s3://{INVENTORY_BUCKET}/{INVENTORY_PREFIX}"
+                f"{' (S3 Select)' if INVENTORY_SELECT else ''}")
+
+if not ACCESS_KEY or not SECRET_KEY:
+    logger.error("ERROR: ACCESS_KEY and SECRET_KEY must be set!")
+    logger.error("Please set these environment variables in CapRover.")
+    exit(1)
+
+if not BUCKETS or BUCKETS == ['']:
+    logger.error("ERROR: BUCKETS environment variable must be set!")
+    logger.error("Example: BUCKETS=bucket1,bucket2,bucket3")
+    exit(1)
+
+if SCRAPE_INTERVAL <= 0:
+    logger.error("ERROR: SCRAPE_INTERVAL must be a positive number of seconds!")
+    exit(1)
+
+if USE_INVENTORY and not INVENTORY_BUCKET:
+    logger.error("ERROR: INVENTORY_BUCKET must be set when USE_INVENTORY=1!")
+    exit(1)
+
+if ASYNC_LISTING and aiohttp is None:
+    logger.error("ERROR: ASYNC_LISTING=1 requires the aiohttp package!")
+    exit(1)
+
+logger.info(f"Access Key: {ACCESS_KEY[:8]}...{ACCESS_KEY[-4:]}")
+logger.info("=" * 60)
+
+def iso_to_datetime(value):
+    """Convert an S3 ISO-8601 UTC timestamp string to an aware datetime"""
+    # Unlike datetime.fromisoformat on Python 3.9, this accepts any number
+    # of fractional second digits
+    return parse_timestamp(value)
+
+def iso_to_timestamp(value):
+    """Convert an S3 ISO-8601 UTC timestamp string to epoch seconds, 0 if empty"""
+    if not value:
+        return 0
+    return iso_to_datetime(value).timestamp()
+
+def aggregate_list_response(response_dict, customized_response_dict, **kwargs):
+    """botocore before-parse handler replacing ListObjectsV2 Contents with a ContentsAggregate"""
+    if response_dict['status_code'] != 200:
+        return
+    
+    # botocore then only parses the small remainder (truncation flag, tokens)
+    root, aggregate = aggregate_list_body(response_dict['body'])
+    response_dict['body'] = etree.tostring(root)
+    customized_response_dict['ContentsAggregate'] = aggregate
+
+def parse_list_page(body):
+    """Aggregate a raw ListObjectsV2 XML page
+    
+    Returns (size, count, latest modified ISO string, last key, next token).
+    """
+    root, aggregate = aggregate_list_body(body)
+    namespace = root.tag[:root.tag.find('}') + 1]
+    next_token = root.findtext(namespace + 'NextContinuationToken')
+    
+    return aggregate + (next_token,)
+
+def create_s3_client(parameter_validation=True):
+    """Create an S3 client for the configured endpoint"""
+    return boto3.client('s3',
+        endpoint_url=ENDPOINT_URL,
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        region_name=REGION_NAME,
+        config=Config(
+            signature_version='s3v4',
+            retries={'max_attempts': 3, 'mode': 'standard'},
+            # Buckets and their shards are listed concurrently over this
+            # shared client, so give every listing its own pooled connection
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+            parameter_validation=parameter_validation
+        )
+    )
+
+def create_list_client():
+    """Create the client for the ListObjectsV2 hot path with per-request checks trimmed"""
+    # Listing calls always have the same trusted shape, so skip input
+    # validation and the bucket name check that run before every page
+    client = create_s3_client(parameter_validation=False)
+    client.meta.events.unregister('before-parameter-build.s3', validate_bucket_name)
+    # Aggregate listing pages while parsing instead of building a dict and
+    # datetime for every object
+    client.meta.events.register('before-parse.s3.ListObjectsV2', aggregate_list_response)
+    return client
+
+# Setup S3 client
+try:
+    s3 = create_s3_client()
+    list_client = create_list_client()
+    logger.info("✓ S3 client created successfully")
+except Exception as e:
+    logger.error(f"✗ Failed to create S3 client: {e}")
+    exit(1)
+
+# SigV4 signer for the async listing path, built once and shared by all requests
+list_signer = S3SigV4Auth(Credentials(ACCESS_KEY, SECRET_KEY), 's3', REGION_NAME)
+
+# Prometheus metrics
+bucket_size = Gauge('idrive_bucket_size_bytes', 
+                    'Total size of bucket in bytes', 
+                    ['bucket'])
+object_count = Gauge('idrive_bucket_object_count', 
+                     'Number of objects in bucket', 
+                     ['bucket'])
+last_modified = Gauge('idrive_bucket_last_modified', 
+                      'Timestamp of last modified object', 
+                      ['bucket'])
+scrape_duration = Gauge('idrive_scrape_duration_seconds',
+                        'Time taken to scrape metrics',
+                        ['bucket'])
+scrape_success = Gauge('idrive_scrape_success',
+                       'Whether the last scrape was successful',
+                       ['bucket'])
+exporter_info = Info('idrive_exporter', 'Exporter information')
+exporter_health = Gauge('idrive_exporter_healthy',
+                        'Overall health status of the exporter (1=healthy, 0=unhealthy)')
+bucket_health = Gauge('idrive_bucket_healthy',
+                      'Health status of individual bucket (1=healthy, 0=unhealthy)',
+                      ['bucket'])
+
+# Set exporter info
+exporter_info.info({
+    'version': '1.0',
+    'endpoint': ENDPOINT_URL,
+    'buckets': ','.join(BUCKETS)
+})
+
+# Labelled children are resolved the first time a bucket publishes them and
+# reused after that. Creating them up front would export every series as 0
+# until the bucket's first scan finishes.
+METRIC_GAUGES = {
+    'size': bucket_size,
+    'count': object_count,
+    'last_modified': last_modified,
+    'duration': scrape_duration,
+    'success': scrape_success,
+    'health': bucket_health
+}
+METRIC_HANDLES = {bucket: {} for bucket in (b.strip() for b in BUCKETS) if bucket}
+
+def metric_handle(bucket_name, metric):
+    """Return a bucket's labelled child of a gauge, resolving and caching it on first use"""
+    handles = METRIC_HANDLES[bucket_name]
+    handle = handles.get(metric)
+    if handle is None:
+        handle = handles[metric] = METRIC_GAUGES[metric].labels(bucket=bucket_name)
+    return handle
+
+class BucketStatus:
+    """Fixed-schema result of a bucket's last scrape, formatted only when /health is requested"""
+    __slots__ = ('success', 'objects', 'size', 'mtime_epoch', 'duration', 'last_check_epoch', 'error')
+    
+    def __init__(self):
+        self.success = False
+        self.objects = 0
+        self.size = 0
+        self.mtime_epoch = 0
+        self.duration = 0.0
+        self.last_check_epoch = None
+        self.error = None
+    
+    def copy(self):
+        """Return an independent copy for publishing in a health snapshot"""
+        status = BucketStatus()
+        for field in self.__slots__:
+            setattr(status, field, getattr(self, field))
+        return status
+    
+    def to_dict(self):
+        """Format the status as its /health JSON entry"""
+        last_check = datetime.fromtimestamp(self.last_check_epoch).isoformat()
+        if not self.success:
+            return {
+                'success': False,
+                'error': self.error,
+                'last_check': last_check
+            }
+        
+        if self.mtime_epoch > 0:
+            last_mod_str = datetime.fromtimestamp(self.mtime_epoch).strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            last_mod_str = "N/A"
+        
+        return {
+            'success': True,
+            'objects': self.objects,
+            'size_bytes': self.size,
+            'size_gb': round(self.size / (1024**3), 2),
+            'last_modified': last_mod_str,
+            'scrape_duration_seconds': round(self.duration, 2),
+            'last_check': last_check
+        }
+
+# Health status tracking
+health_status = {
+    'healthy': True,
+    'last_successful_scrape': None
+}
+# Pre-allocated per bucket and updated in place by the scrapers
+BUCKET_STATUS = {bucket: BucketStatus() for bucket in METRIC_HANDLES}
+# Bucket scrapes run in worker threads, so guard writes to BUCKET_STATUS
+health_lock = threading.Lock()
+
+# Last scan result per bucket: (timestamp, size, count, latest modified, probe, last key)
+bucket_cache = {}
+
+# Persisted listing state per bucket, used to resume scans with StartAfter
+bucket_state = {}
+state_lock = threading.Lock()
+
+if STATE_FILE and os.path.exists(STATE_FILE):
+    try:
+        with open(STATE_FILE) as f:
+            bucket_state = json.load(f)
+        logger.info(f"✓ Loaded state for {len(bucket_state)} bucket(s) from {STATE_FILE}")
+    except Exception as e:
+        logger.warning(f"⚠ Failed to load state from {STATE_FILE}, starting fresh: {e}")
+
+def save_state():
+    """Atomically write the persisted listing state to STATE_FILE"""
+    with state_lock:
+        data = json.dumps(bucket_state)
+    tmp_file = f"{STATE_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(data)
+    os.replace(tmp_file, STATE_FILE)
+
+def build_health_snapshot():
+    """Copy the current bucket statuses into an immutable health snapshot"""
+    with health_lock:
+        buckets = {name: status.copy() for name, status in BUCKET_STATUS.items()
+                   if status.last_check_epoch is not None}
+    
+    return {
+        'last_scrape': health_status['last_successful_scrape'],
+        'buckets': buckets
+    }
+
+def build_health_response(snapshot):
+    """Format a health snapshot as (HTTP status code, /health response)"""
+    buckets = {name: status.to_dict() for name, status in snapshot['buckets'].items()}
+    last_scrape = snapshot['last_scrape']
+    
+    # Calculate overall health
+    healthy_buckets = sum(1 for b in buckets.values() if b['success'])
+    all_buckets_healthy = bool(buckets) and healthy_buckets == len(buckets)
+    
+    # Prepare response
+    response = {
+        'status': 'healthy' if all_buckets_healthy else 'unhealthy',
+        'exporter_version': '1.0',
+        'endpoint': ENDPOINT_URL,
+        'last_scrape': datetime.fromtimestamp(last_scrape).isoformat() if last_scrape else None,
+        'buckets': buckets,
+        'summary': {
+            'total_buckets': len(buckets),
+            'healthy_buckets': healthy_buckets,
+            'unhealthy_buckets': len(buckets) - healthy_buckets
+        }
+    }
+    
+    # HTTP status code: 200 if healthy, 503 if unhealthy
+    return 200 if all_buckets_healthy else 503, response
+
+# Replaced wholesale after every collection; reads need no lock
+HEALTH_SNAPSHOT = build_health_snapshot()
+
+# Static responses are serialized once at startup
+ROOT_RESPONSE = orjson.dumps({
+    'service': 'iDrive e2 Prometheus Exporter',
+    'version': '1.0',
+    'endpoints': {
+        '/health': 'Health check endpoint (JSON)',
+        '/metrics': 'Prometheus metrics (port 8000)'
+    }
+}, option=orjson.OPT_INDENT_2)
+NOT_FOUND_RESPONSE = orjson.dumps({'error': 'Not found'})
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Simple health check endpoint"""
+    
+    def do_GET(self):
+        if self.path == '/health':
+            # Serve the snapshot published by the last collection; it is
+            # never mutated, so no locking is needed here
+            status_code, response = build_health_response(HEALTH_SNAPSHOT)
+            
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(orjson.dumps(response, option=orjson.OPT_INDENT_2))
+            
+        elif self.path == '/':
+            # Simple root endpoint with info
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(ROOT_RESPONSE)
+            
+        else:
+            self.send_response(404)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(NOT_FOUND_RESPONSE)
+    
+    def log_message(self, format, *args):
+        # Suppress default logging to avoid clutter
+        pass
+
+def test_connection():
+    """Test S3 connection by listing buckets"""
+    try:
+        logger.info("Testing connection by listing buckets...")
+        response = s3.list_buckets()
+        available_buckets = [b['Name'] for b in response.get('Buckets', [])]
+        logger.info(f"✓ Connection successful! Found {len(available_buckets)} bucket(s):")
+        for bucket in available_buckets:
+            logger.info(f"  - {bucket}")
+        
+        # Check if configured buckets exist
+        for bucket in BUCKETS:
+            bucket = bucket.strip()
+            if bucket and bucket not in available_buckets:
+                logger.warning(f"⚠ Bucket '{bucket}' not found in account!")
+        
+        return True
+    except Exception as e:
+        logger.error(f"✗ Connection test failed: {e}")
+        return False
+
+def list_params(bucket_name, prefix='', start_after=''):
+    """Build ListObjectsV2 arguments, leaving out the optional ones that are unset"""
+    # Some S3-compatible stores do not treat an empty parameter as absent
+    params = {'Bucket': bucket_name}
+    if prefix:
+        params['Prefix'] = prefix
+    if start_after:
+        params['StartAfter'] = start_after
+    return params
+
+# Set once the fallback for a botocore without before-parse events was logged
+list_hook_warned = False
+
+def page_totals(page):
+    """Return (size, count, latest modified datetime, last key) of a ListObjectsV2 page"""
+    # list_client folds Contents into one aggregate while parsing; fall
+    # back to the parsed objects if the hook did not run
+    contents_aggregate = page.get('ContentsAggregate')
+    contents = page.get('Contents')
+    if contents_aggregate and contents_aggregate[1]:
+        page_size, page_objects, page_modified, page_last_key = contents_aggregate
+        return page_size, page_objects, iso_to_datetime(page_modified), page_last_key
+    if contents:
+        global list_hook_warned
+        if not list_hook_warned:
+            list_hook_warned = True
+            logger.warning("⚠ botocore did not run the before-parse listing hook, "
+                           "parsing every object instead; upgrade boto3 to the pinned version")
+        page_size, page_objects, page_modified = aggregate(contents)
+        # Keys are listed in order, so the last one is the greatest
+        return page_size, page_objects, page_modified, contents[-1]['Key']
+    return 0, 0, None, None
+
+def scan_prefix(bucket_name, prefix='', start_after=''):
+    """List objects under a prefix and return (size, count, latest modified, last key)"""
+    total_size = 0
+    total_objects = 0
+    latest_modified = None
+    last_key = None
+    
+    # List all objects with pagination
+    paginator = list_client.get_paginator('list_objects_v2')
+    page_count = 0
+    
+    # Only Size, LastModified and Key are used, so never ask for owners and
+    # always request full 1000-key pages
+    for page in paginator.paginate(**list_params(bucket_name, prefix, start_after), FetchOwner=False,
+                                   PaginationConfig={'PageSize': 1000}):
+        page_count += 1
+        page_size, page_objects, page_modified, page_last_key = page_totals(page)
+        
+        if page_objects:
+            total_size += page_size
+            total_objects += page_objects
+            
+            # Track latest modification, comparing datetimes directly and
+            # converting to a timestamp only once at the end
+            if latest_modified is None or page_modified > latest_modified:
+                latest_modified = page_modified
+            last_key = page_last_key
+            
+            # Log progress every 10 pages
+            if page_count % 10 == 0:
+                logger.info(f"  Processing {bucket_name}/{prefix} page {page_count}... "
+                          f"({total_objects} objects so far)")
+    
+    latest_ts = latest_modified.timestamp() if latest_modified else 0
+    
+    return total_size, total_objects, latest_ts, last_key
+
+def split_prefix(bucket_name, prefix, start_after, budget):
+    """Find the distinct one-character extensions of a prefix among keys after start_after
+    
+    Spends one MaxKeys=1 listing per extension. Returns (extensions, totals
+    of the object named exactly like the prefix, if any, listings used), or
+    None if that would take more than budget listings.
+    """
+    extensions = []
+    exact = (0, 0, 0, None)
+    requests = 0
+    
+    while True:
+        if requests == budget:
+            return None
+        response = list_client.list_objects_v2(**list_params(bucket_name, prefix, start_after),
+                                               FetchOwner=False, MaxKeys=1)
+        requests += 1
+        size, count, modified, key = page_totals(response)
+        if not count:
+            break
+        
+        if key == prefix:
+            # Not covered by any extension, so count it here
+            exact = (size, 1, modified.timestamp(), key)
+            next_start_after = key
+        else:
+            extension = key[:len(prefix) + 1]
+            if not extensions or extensions[-1] != extension:
+                extensions.append(extension)
+                # Skip past every key starting with this extension
+                next_start_after = extension + '\U0010ffff'
+            else:
+                # A key sorting after the skip marker, keep walking
+                next_start_after = key
+        
+        # A store returning keys that do not sort after StartAfter would
+        # otherwise keep this loop going forever
+        if next_start_after <= start_after:
+            raise ValueError(f"Listing of {bucket_name} returned '{key}', which does not sort after StartAfter")
+        start_after = next_start_after
+    
+    return extensions, exact, requests
+
+def split_keyspace(bucket_name):
+    """Count the start of a bucket and split the rest into key prefixes that can be listed in parallel
+    
+    Returns (totals already counted, cursor, shard prefixes). Shards only
+    cover keys after the cursor. Buckets that fit in SHARD_WORKERS listing
+    pages are counted directly and not split.
+    """
+    total_size = 0
+    total_objects = 0
+    latest_modified = None
+    last_key = None
+    truncated = False
+    
+    # List the first pages sequentially: most buckets end here, and only
+    # the ones that do not are worth the split listings below
+    paginator = list_client.get_paginator('list_objects_v2')
+    for page_count, page in enumerate(paginator.paginate(Bucket=bucket_name, FetchOwner=False,
+                                                         PaginationConfig={'PageSize': 1000})):
+        if page_count == SHARD_WORKERS:
+            truncated = True
+            break
+        page_size, page_objects, page_modified, page_last_key = page_totals(page)
+        if page_objects:
+            total_size += page_size
+            total_objects += page_objects
+            if latest_modified is None or page_modified > latest_modified:
+                latest_modified = page_modified
+            last_key = page_last_key
+    
+    totals = (total_size, total_objects, latest_modified.timestamp() if latest_modified else 0, last_key)
+    if not truncated:
+        return totals, last_key, []
+    
+    # Split the remaining keys one shard at a time, descending one key
+    # character at a time so flat buckets and buckets with everything under
+    # a single folder are split as well
+    shards = deque([''])
+    requests = 0
+    while shards and len(shards) < SHARD_WORKERS:
+        prefix = shards.popleft()
+        split = split_prefix(bucket_name, prefix, last_key, MAX_SPLIT_REQUESTS - requests)
+        if split is None:
+            # Out of split listings, list this shard as is
+            shards.appendleft(prefix)
+            break
+        extensions, exact, used = split
+        requests += used
+        shards.extend(extensions)
+        totals = merge_totals(totals, exact)
+    
+    return totals, last_key, list(shards)
+
+def merge_totals(totals, other):
+    """Combine two (size, count, latest modified, last key) tuples"""
+    last_key = totals[3]
+    if other[3] is not None and (last_key is None or other[3] > last_key):
+        last_key = other[3]
+    return totals[0] + other[0], totals[1] + other[1], max(totals[2], other[2]), last_key
+
+def raise_list_error(status, body):
+    """Raise the boto3 exception matching an S3 XML error response"""
+    try:
+        root = ElementTree.fromstring(body)
+        code = root.findtext('Code')
+        message = root.findtext('Message')
+    except ElementTree.ParseError:
+        code = str(status)
+        message = body[:200].decode(errors='replace')
+    error_response = {
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status}
+    }
+    raise s3.exceptions.from_code(code)(error_response, 'ListObjectsV2')
+
+async def fetch_list_page(session, bucket_name, params):
+    """Sign and send one ListObjectsV2 request, returning the parsed page aggregate"""
+    # Keys are sent pre-encoded and sorted so the URL matches the canonical
+    # query string that the signature is computed over
+    query = '&'.join(f"{quote(key, safe='-_.~')}={quote(value, safe='-_.~')}"
+                     for key, value in sorted(params.items()))
+    url = f"{ENDPOINT_URL.rstrip('/')}/{bucket_name}?{query}"
+    
+    for attempt in range(3):
+        request = AWSRequest(method='GET', url=url)
+        list_signer.add_auth(request)
+        try:
+            async with session.get(yarl.URL(url, encoded=True), headers=dict(request.headers.items())) as response:
+                status = response.status
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == 2:
+                raise
+            await asyncio.sleep(2 ** attempt)
+            continue
+        
+        if status == 200:
+            return parse_list_page(body)
+        if status < 500 or attempt == 2:
+            raise_list_error(status, body)
+        await asyncio.sleep(2 ** attempt)
+
+async def scan_prefix_async(session, bucket_name, prefix='', start_after=''):
+    """Async counterpart of scan_prefix returning the same tuple"""
+    total_size = 0
+    total_objects = 0
+    latest_modified = ''
+    last_key = None
+    
+    params = {'list-type': '2', 'encoding-type': 'url', 'max-keys': '1000'}
+    if prefix:
+        params['prefix'] = prefix
+    if start_after:
+        params['start-after'] = start_after
+    page_count = 0
+    
+    while True:
+        page_size, page_objects, page_modified, page_last_key, next_token = \
+            await fetch_list_page(session, bucket_name, params)
+        page_count += 1
+        
+        total_size += page_size
+        total_objects += page_objects
+        latest_modified = max(latest_modified, page_modified)
+        last_key = page_last_key or last_key
+        
+        # Log progress every 10 pages
+        if page_count % 10 == 0:
+            logger.info(f"  Processing {bucket_name}/{prefix} page {page_count}... "
+                      f"({total_objects} objects so far)")
+        
+        if not next_token:
+            break
+        params['continuation-token'] = next_token
+    
+    return total_size, total_objects, iso_to_timestamp(latest_modified), last_key
+
+# Async listings run on one long-lived event loop with a single session, so
+# pooled connections and the DNS cache are shared by all buckets and scans
+list_loop = None
+list_session = None
+list_loop_lock = threading.Lock()
+
+def run_listing(coroutine):
+    """Run a listing coroutine on the shared event loop and wait for its result"""
+    global list_loop
+    with list_loop_lock:
+        if list_loop is None:
+            list_loop = asyncio.new_event_loop()
+            threading.Thread(target=list_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, list_loop).result()
+
+def get_list_session():
+    """Return the shared aiohttp session, creating it on first use (on the listing loop)"""
+    global list_session
+    if list_session is None:
+        # All listings talk to the same endpoint; idle connections are kept
+        # for a minute and DNS lookups are cached for five
+        connector = aiohttp.TCPConnector(limit=MAX_POOL_CONNECTIONS, limit_per_host=MAX_POOL_CONNECTIONS,
+                                         keepalive_timeout=60, ttl_dns_cache=300)
+        list_session = aiohttp.ClientSession(connector=connector)
+    return list_session
+
+def close_listing():
+    """Close the shared aiohttp session and stop the listing loop"""
+    global list_loop, list_session
+    if list_loop is None:
+        return
+    if list_session is not None:
+        asyncio.run_coroutine_threadsafe(list_session.close(), list_loop).result()
+    list_loop.call_soon_threadsafe(list_loop.stop)
+    list_loop = None
+    list_session = None
+
+atexit.register(close_listing)
+
+async def scan_listing_async(bucket_name, shards, start_after=''):
+    """List shard prefixes (after start_after, if set) concurrently and return a result per shard"""
+    session = get_list_session()
+    return await asyncio.gather(*(scan_prefix_async(session, bucket_name, prefix, start_after)
+                                  for prefix in shards))
+
+def scan_inventory(bucket_name):
+    """Aggregate the latest S3 Inventory report for a bucket, or return None if unavailable"""
+    # Reports live under <prefix>/<source bucket>/<config id>/<YYYY-MM-DDTHH-MMZ>/manifest.json
+    prefix = f"{INVENTORY_PREFIX}/{bucket_name}/" if INVENTORY_PREFIX else f"{bucket_name}/"
+    manifests = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=INVENTORY_BUCKET, Prefix=prefix):
+        manifests.extend(obj['Key'] for obj in page.get('Contents', [])
+                         if obj['Key'].endswith('/manifest.json'))
+    
+    if not manifests:
+        logger.warning(f"⚠ No inventory report found for {bucket_name}, falling back to listing")
+        return None
+    
+    manifest_key = max(manifests, key=lambda key: key.rsplit('/', 2)[-2])
+    manifest = json.loads(s3.get_object(Bucket=INVENTORY_BUCKET, Key=manifest_key)['Body'].read())
+    columns = [column.strip() for column in manifest.get('fileSchema', '').split(',')]
+    
+    if manifest.get('fileFormat', '').upper() != 'CSV' or 'Size' not in columns:
+        logger.warning(f"⚠ Inventory report {manifest_key} is not a CSV report with a Size column, "
+                       f"falling back to listing")
+        return None
+    
+    logger.info(f"  Reading inventory report {manifest_key}")
+    size_column = columns.index('Size')
+    modified_column = columns.index('LastModifiedDate') if 'LastModifiedDate' in columns else None
+    # Versioned reports list every version; only count current, non-deleted objects
+    is_latest_column = columns.index('IsLatest') if 'IsLatest' in columns else None
+    delete_marker_column = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+    
+    total_size = 0
+    total_objects = 0
+    latest_modified = ''
+    selected_modified = 0
+    
+    for data_file in manifest['files']:
+        if INVENTORY_SELECT:
+            try:
+                file_size, file_objects, file_modified = select_inventory_file(data_file['key'], columns)
+                total_size += file_size
+                total_objects += file_objects
+                selected_modified = max(selected_modified, file_modified)
+                continue
+            except Exception as e:
+                logger.warning(f"⚠ S3 Select failed for {data_file['key']}, downloading it instead: {e}")
+        
+        body = s3.get_object(Bucket=INVENTORY_BUCKET, Key=data_file['key'])['Body']
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding='utf-8') as stream:
+            for row in csv.reader(stream):
+                if is_latest_column is not None and row[is_latest_column] != 'true':
+                    continue
+                if delete_marker_column is not None and row[delete_marker_column] == 'true':
+                    continue
+                
+                total_size += int(row[size_column] or 0)
+                total_objects += 1
+                
+                # ISO-8601 UTC timestamps sort lexicographically
+                if modified_column is not None and row[modified_column] > latest_modified:
+                    latest_modified = row[modified_column]
+    
+    return total_size, total_objects, max(iso_to_timestamp(latest_modified), selected_modified)
+
+def select_inventory_file(key, columns):
+    """Aggregate one gzipped inventory CSV server-side with S3 Select
+    
+    Only a single result row crosses the network instead of the whole file.
+    Returns (size, count, latest modified timestamp).
+    """
+    def column(name):
+        return f"s._{columns.index(name) + 1}"
+    
+    fields = ["COUNT(*)", f"SUM(CAST({column('Size')} AS INT))"]
+    if 'LastModifiedDate' in columns:
+        # MAX only accepts numbers, so take it over seconds since the epoch
+        fields.append(f"MAX(DATE_DIFF(second, TO_TIMESTAMP('1970-01-01T00:00:00Z'), "
+                      f"TO_TIMESTAMP({column('LastModifiedDate')})))")
+    
+    # Versioned reports list every version; only count current, non-deleted objects
+    conditions = []
+    if 'IsLatest' in columns:
+        conditions.append(f"{column('IsLatest')} = 'true'")
+    if 'IsDeleteMarker' in columns:
+        conditions.append(f"{column('IsDeleteMarker')} <> 'true'")
+    
+    expression = f"SELECT {', '.join(fields)} FROM S3Object s"
+    if conditions:
+        expression += f" WHERE {' AND '.join(conditions)}"
+    
+    response = s3.select_object_content(
+        Bucket=INVENTORY_BUCKET,
+        Key=key,
+        ExpressionType='SQL',
+        Expression=expression,
+        InputSerialization={'CSV': {'FileHeaderInfo': 'NONE'}, 'CompressionType': 'GZIP'},
+        OutputSerialization={'CSV': {}}
+    )
+    records = b''.join(event['Records']['Payload'] for event in response['Payload'] if 'Records' in event)
+    row = next(csv.reader(io.StringIO(records.decode('utf-8'))), None)
+    if not row:
+        raise ValueError("S3 Select returned no rows")
+    
+    latest_modified = float(row[2] or 0) if len(row) > 2 else 0
+    return int(row[1] or 0), int(row[0]), latest_modified
+
+def probe_bucket(bucket_name):
+    """Return a cheap change signature for a bucket from its first listed object"""
+    # Uses the regular client: the list client folds Contents into an aggregate
+    response = s3.list_objects_v2(Bucket=bucket_name, MaxKeys=1)
+    contents = response.get('Contents')
+    if not contents:
+        return None
+    return contents[0]['Key'], contents[0]['ETag'], contents[0]['LastModified']
+
+def has_keys_after(bucket_name, last_key):
+    """Return whether a bucket has any key sorting after last_key"""
+    if last_key is None:
+        return False
+    response = s3.list_objects_v2(Bucket=bucket_name, StartAfter=last_key, MaxKeys=1)
+    return response.get('KeyCount', 0) > 0
+
+def scan_bucket(bucket_name):
+    """Return (size, count, latest modified) for a bucket, reusing cached totals when unchanged"""
+    if not CACHE_TTL:
+        return scan_bucket_uncached(bucket_name)[:3]
+    
+    # The first object catches changes at the start of the keyspace and the
+    # StartAfter check catches keys appended after the last scanned one.
+    # Deletes, overwrites and inserts elsewhere wait for the TTL to expire.
+    probe = probe_bucket(bucket_name)
+    cached = bucket_cache.get(bucket_name)
+    if (cached and time.time() - cached[0] < CACHE_TTL and cached[4] == probe
+            and not has_keys_after(bucket_name, cached[5])):
+        logger.info(f"  {bucket_name} unchanged since last scan, using cached totals")
+        return cached[1:4]
+    
+    result = scan_bucket_uncached(bucket_name)
+    # Each bucket is only scanned by one worker at a time, so no lock is needed
+    bucket_cache[bucket_name] = (time.time(),) + result[:3] + (probe, result[3])
+    return result[:3]
+
+def scan_bucket_uncached(bucket_name):
+    """Return (size, count, latest modified, last key) for a bucket"""
+    if USE_INVENTORY:
+        result = scan_inventory(bucket_name)
+        if result is not None:
+            # Inventory reports do not give the last key
+            return result + (None,)
+    
+    if not STATE_FILE:
+        return scan_listing(bucket_name)
+    
+    with state_lock:
+        state = bucket_state.get(bucket_name)
+    
+    if state and state['incremental_scans'] < FULL_RESCAN_EVERY:
+        # Only list keys after the previous cursor and add them to the stored
+        # totals. This assumes append-mostly buckets; deletes and overwrites
+        # are reconciled by the next full rescan.
+        start_after = state['last_key'] or ''
+        logger.info(f"  Scanning {bucket_name} incrementally after '{start_after}'")
+        new_size, new_objects, new_modified, new_last_key = scan_listing(
+            bucket_name, start_after=start_after)
+        state = {
+            'size': state['size'] + new_size,
+            'count': state['count'] + new_objects,
+            'latest_modified': max(state['latest_modified'], new_modified),
+            'last_key': new_last_key or state['last_key'],
+            'incremental_scans': state['incremental_scans'] + 1
+        }
+    else:
+        total_size, total_objects, latest_modified, last_key = scan_listing(bucket_name)
+        state = {
+            'size': total_size,
+            'count': total_objects,
+            'latest_modified': latest_modified,
+            'last_key': last_key,
+            'incremental_scans': 0
+        }
+    
+    with state_lock:
+        bucket_state[bucket_name] = state
+    
+    return state['size'], state['count'], state['latest_modified'], state['last_key']
+
+def scan_listing(bucket_name, start_after=''):
+    """List a bucket (after start_after, if set) and return (size, count, latest modified, last key)"""
+    if start_after:
+        if ASYNC_LISTING:
+            return run_listing(scan_listing_async(bucket_name, [''], start_after))[0]
+        return scan_prefix(bucket_name, start_after=start_after)
+    
+    # Small buckets are counted while probing; the rest of large ones is
+    # split into key prefix shards that are listed in parallel
+    totals, cursor, shards = split_keyspace(bucket_name)
+    
+    if shards:
+        logger.info(f"  Listing {len(shards)} shard(s) of {bucket_name}...")
+        if ASYNC_LISTING:
+            results = run_listing(scan_listing_async(bucket_name, shards, cursor))
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(shards), SHARD_WORKERS)) as executor:
+                results = list(executor.map(lambda prefix: scan_prefix(bucket_name, prefix, cursor), shards))
+        for result in results:
+            totals = merge_totals(totals, result)
+    
+    return totals
+
+def scrape_bucket(bucket_name):
+    """Scan a bucket and return (bucket name, result) without touching metrics or health"""
+    start_time = time.time()
+    logger.info(f"→ Collecting metrics for: {bucket_name}")
+    
+    try:
+        total_size, total_objects, latest_modified = scan_bucket(bucket_name)
+        result = {
+            'success': True,
+            'objects': total_objects,
+            'size': total_size,
+            'latest_modified': latest_modified
+        }
+    except s3.exceptions.NoSuchBucket:
+        logger.error(f"✗ Bucket '{bucket_name}' does not exist!")
+        result = {'success': False, 'error': 'Bucket not found'}
+    except Exception as e:
+        # Some exceptions, such as timeouts, have no message
+        error = str(e) or type(e).__name__
+        logger.error(f"✗ Error collecting metrics for {bucket_name}: {error}")
+        result = {'success': False, 'error': error}
+    
+    result['duration'] = time.time() - start_time
+    return bucket_name, result
+
+def scrape_bucket_return_state(args):
+    """Process pool worker: scrape a bucket and hand its scan state back to the parent"""
+    bucket_name, state, cache = args
+    with state_lock:
+        if state is not None:
+            bucket_state[bucket_name] = state
+        if cache is not None:
+            bucket_cache[bucket_name] = cache
+    
+    bucket_name, result = scrape_bucket(bucket_name)
+    
+    with state_lock:
+        result['state'] = bucket_state.get(bucket_name)
+        result['cache'] = bucket_cache.get(bucket_name)
+    return bucket_name, result
+
+def init_scrape_process():
+    """Process pool initializer: give each worker its own S3 clients and listing loop"""
+    global s3, list_client, list_loop, list_session
+    s3 = create_s3_client()
+    list_client = create_list_client()
+    # A forked worker inherits the parent's loop but not the thread running it
+    list_loop = None
+    list_session = None
+
+def publish_bucket_result(bucket_name, result):
+    """Update Prometheus metrics and the bucket's status from a scrape_bucket result"""
+    status = BUCKET_STATUS[bucket_name]
+    
+    if not result['success']:
+        metric_handle(bucket_name, 'success').set(0)
+        metric_handle(bucket_name, 'health').set(0)
+        with health_lock:
+            status.success = False
+            status.error = result['error']
+            status.last_check_epoch = time.time()
+        return
+    
+    total_size = result['size']
+    total_objects = result['objects']
+    latest_modified = result['latest_modified']
+    duration = result['duration']
+    
+    # Update Prometheus metrics
+    metric_handle(bucket_name, 'size').set(total_size)
+    metric_handle(bucket_name, 'count').set(total_objects)
+    
+    if latest_modified > 0:
+        metric_handle(bucket_name, 'last_modified').set(latest_modified)
+    
+    metric_handle(bucket_name, 'success').set(1)
+    metric_handle(bucket_name, 'health').set(1)
+    metric_handle(bucket_name, 'duration').set(duration)
+    
+    # Update health status
+    with health_lock:
+        status.success = True
+        status.objects = total_objects
+        status.size = total_size
+        status.mtime_epoch = latest_modified
+        status.duration = duration
+        status.last_check_epoch = time.time()
+        status.error = None
+    
+    logger.info(f"✓ {bucket_name}:")
+    logger.info(f"  - Objects: {total_objects:,}")
+    logger.info(f"  - Size: {total_size / (1024**3):.2f} GB")
+    if latest_modified > 0:
+        logger.info(f"  - Last modified: {datetime.fromtimestamp(latest_modified):%Y-%m-%d %H:%M:%S}")
+    else:
+        logger.info("  - Last modified: N/A")
+    logger.info(f"  - Collection time: {duration:.2f}s")
+
+def collect_bucket_metrics(bucket_name):
+    """Collect metrics for a single bucket"""
+    bucket_name = bucket_name.strip()
+    if not bucket_name:
+        return
+    
+    publish_bucket_result(*scrape_bucket(bucket_name))
+
+# Worker pool for many buckets, kept for the life of the exporter so workers
+# reuse their clients and connections across collections
+scrape_pool = None
+
+def start_process_pool():
+    """Start the scrape worker pool if more than PROCESS_POOL_THRESHOLD buckets are configured
+    
+    main() calls this before starting any threads, so the workers are forked
+    from a single-threaded process.
+    """
+    global scrape_pool
+    bucket_count = sum(1 for b in BUCKETS if b.strip())
+    if scrape_pool is not None or bucket_count <= PROCESS_POOL_THRESHOLD:
+        return
+    
+    processes = min(multiprocessing.cpu_count(), 8)
+    logger.info(f"Starting {processes} worker processes for {bucket_count} buckets")
+    scrape_pool = multiprocessing.Pool(processes=processes, initializer=init_scrape_process)
+    atexit.register(scrape_pool.terminate)
+
+def collect_with_processes(bucket_names):
+    """Scrape buckets in the process pool and publish the results in this process"""
+    with state_lock:
+        tasks = [(name, bucket_state.get(name), bucket_cache.get(name)) for name in bucket_names]
+    
+    start_process_pool()
+    logger.info(f"Scraping {len(bucket_names)} buckets in worker processes")
+    for bucket_name, result in scrape_pool.imap_unordered(scrape_bucket_return_state, tasks):
+        # Gauges and scan state are per process, so merge them back here
+        state = result.pop('state')
+        cache = result.pop('cache')
+        with state_lock:
+            if state is not None:
+                bucket_state[bucket_name] = state
+            if cache is not None:
+                bucket_cache[bucket_name] = cache
+        publish_bucket_result(bucket_name, result)
+
+def collect_all_metrics():
+    """Collect metrics for all configured buckets"""
+    logger.info("")
+    logger.info("=" * 60)
+    logger.info(f"Starting metrics collection at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.info("=" * 60)
+    
+    start_time = time.time()
+    all_success = True
+    
+    bucket_names = [b.strip() for b in BUCKETS if b.strip()]
+    if len(bucket_names) > PROCESS_POOL_THRESHOLD:
+        # With many buckets, XML parsing in botocore makes scanning CPU-bound
+        # enough to contend on the GIL, so fan out to worker processes
+        collect_with_processes(bucket_names)
+    else:
+        # Scraping is I/O-bound on S3 pagination, so scan buckets concurrently
+        with ThreadPoolExecutor(max_workers=min(len(bucket_names), 16) or 1) as executor:
+            list(executor.map(collect_bucket_metrics, bucket_names))
+    
+    # Check if any bucket failed
+    with health_lock:
+        for bucket_name in bucket_names:
+            if not BUCKET_STATUS[bucket_name].success:
+                all_success = False
+    
+    # Update overall health
+    health_status['healthy'] = all_success
+    health_status['last_successful_scrape'] = time.time()
+    
+    # Update Prometheus health metric
+    exporter_health.set(1 if all_success else 0)
+    
+    # Publish the new health snapshot atomically
+    global HEALTH_SNAPSHOT
+    HEALTH_SNAPSHOT = build_health_snapshot()
+    
+    if STATE_FILE:
+        try:
+            save_state()
+        except Exception as e:
+            logger.error(f"✗ Failed to save state to {STATE_FILE}: {e}")
+    
+    total_duration = time.time() - start_time
+    logger.info("=" * 60)
+    logger.info(f"Collection completed in {total_duration:.2f}s")
+    logger.info(f"Overall status: {'✓ Healthy' if all_success else '✗ Unhealthy'}")
+    logger.info("=" * 60)
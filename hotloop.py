@@ -0,0 +1,80 @@
+"""
+Listing page aggregation for the iDrive e2 exporter
+
+Kept in its own typed module so it can be compiled ahead of time with
+mypyc (`mypyc hotloop.py`). A compiled extension is picked up automatically
+by `import hotloop`; without one this pure Python module is used as is.
+"""
+
+import io
+from datetime import datetime
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote_plus
+
+try:
+    from lxml import etree  # type: ignore
+except ImportError:
+    import xml.etree.ElementTree as etree  # type: ignore[no-redef]
+
+get_size = itemgetter('Size')
+get_last_modified = itemgetter('LastModified')
+
+
+def aggregate(contents: List[Dict[str, Any]]) -> Tuple[int, int, Optional[datetime]]:
+    """Return (size, count, latest LastModified) for the Contents of a parsed listing page"""
+    if not contents:
+        return 0, 0, None
+    # The builtins keep the per-object work in C whether or not this
+    # module is compiled
+    total_size: int = sum(map(get_size, contents))
+    latest_modified: datetime = max(map(get_last_modified, contents))
+    return total_size, len(contents), latest_modified
+
+
+def aggregate_list_body(body: bytes) -> Tuple[Any, Tuple[int, int, str, Optional[str]]]:
+    """Fold the Contents of a raw ListObjectsV2 XML page into totals without per-object dicts
+
+    Contents elements are removed from the tree as soon as they are parsed,
+    so memory stays flat. Returns (root element without Contents,
+    (size, count, latest modified ISO string, last key)).
+    """
+    total_size = 0
+    total_objects = 0
+    latest_modified = ''
+    last_key: Optional[str] = None
+    root: Any = None
+    contents_tag = size_tag = modified_tag = key_tag = encoding_tag = ''
+
+    for event, elem in etree.iterparse(io.BytesIO(body), events=('start', 'end')):
+        if root is None:
+            root = elem
+            tag: str = root.tag
+            namespace = tag[:tag.find('}') + 1]
+            contents_tag = namespace + 'Contents'
+            size_tag = namespace + 'Size'
+            modified_tag = namespace + 'LastModified'
+            key_tag = namespace + 'Key'
+            encoding_tag = namespace + 'EncodingType'
+        elif event == 'end' and elem.tag == contents_tag:
+            total_objects += 1
+            # One pass over the children is cheaper than a findtext per field
+            for child in elem:
+                child_tag: str = child.tag
+                if child_tag == size_tag:
+                    total_size += int(child.text)
+                elif child_tag == modified_tag:
+                    # ISO-8601 UTC timestamps sort lexicographically
+                    modified: str = child.text
+                    if modified > latest_modified:
+                        latest_modified = modified
+                elif child_tag == key_tag:
+                    last_key = child.text
+            root.remove(elem)
+
+    # Keys are requested with EncodingType=url, but only decode them if the
+    # store says it honoured that
+    if last_key is not None and root.findtext(encoding_tag) == 'url':
+        last_key = unquote_plus(last_key)
+
+    return root, (total_size, total_objects, latest_modified, last_key)